@@ -1,60 +1,175 @@
 import streamlit as st
-import difflib
 import html
+import threading
 import requests
-from datetime import datetime
-import re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import trafilatura
 import nltk
+import orjson
+import pandas as pd
+import xxhash
 from bs4 import BeautifulSoup
+from diff_match_patch import diff_match_patch
+from rapidfuzz.distance import Indel
 import openai
 
-# Ensure nltk punkt tokenizer is downloaded
-nltk.download('punkt')
+# Ensure nltk punkt tokenizer is downloaded, checking only once per process rather than on every rerun
+@st.cache_resource(show_spinner=False)
+def ensure_punkt():
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        # nltk.download returns False instead of raising; raise so a failed download is not cached
+        if not nltk.download('punkt', quiet=True):
+            raise LookupError("Could not download the nltk punkt tokenizer")
+    return True
+
+try:
+    ensure_punkt()
+except LookupError:
+    # nltk has already logged why the download failed; the next rerun tries again
+    pass
+
+def hash_str(s):
+    return xxhash.xxh3_128_digest(s.encode())
+
+# Cached functions take whole HTML documents; a 128-bit xxh3 digest makes a cheaper cache key
+HASH_FUNCS = {str: hash_str}
+
+# (connect, read) timeouts for every outgoing request
+REQUEST_TIMEOUT = (5, 30)
+
+# Shared across reruns and fetch threads so connections are kept alive between requests, with
+# transient gateway errors from the Wayback Machine retried instead of failing the fetch
+@st.cache_resource(show_spinner=False)
+def http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=Retry(total=3, status_forcelist=[502, 503, 504], backoff_factor=0.3))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# The get_* functions raise on failure so that errors are never cached; their callers report them
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_available_dates(url):
+    api_url = f"https://web.archive.org/cdx/search/cdx?url={url}&output=json&fl=timestamp&collapse=timestamp:6"
+    response = http_session().get(api_url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    # The first row is the CDX field header
+    rows = orjson.loads(response.content)[1:]
+    return list(pd.to_datetime([row[0] for row in rows], format="%Y%m%d%H%M%S").date)
+
+# Archived snapshots don't change, so no ttl; the entry cap bounds memory instead
+@st.cache_data(max_entries=32, show_spinner=False)
+def get_archived_page(url, date):
+    formatted_date = date.strftime("%Y%m%d")
+    api_url = f"https://web.archive.org/web/{formatted_date}id_/{url}"
+    response = http_session().get(api_url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.text
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_current_page(url):
+    response = http_session().get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.text
 
 def fetch_available_dates(url):
     try:
-        api_url = f"https://web.archive.org/cdx/search/cdx?url={url}&output=json&fl=timestamp&collapse=timestamp:6"
-        response = requests.get(api_url)
-        if response.status_code == 200:
-            data = response.json()
-            dates = [datetime.strptime(item[0], "%Y%m%d%H%M%S").date() for item in data[1:]]
-            return dates
+        return get_available_dates(url)
     except Exception as e:
         st.error(f"Error fetching available dates: {e}")
     return []
 
-def fetch_archived_page(url, date):
-    formatted_date = date.strftime("%Y%m%d")
-    api_url = f"https://web.archive.org/web/{formatted_date}id_/{url}"
-    try:
-        response = requests.get(api_url)
-        if response.status_code == 200:
-            return response.text
-    except Exception as e:
+def get_html(url, source_option, date):
+    return get_archived_page(url, date) if source_option == "Archived" else get_current_page(url)
+
+def report_html_error(source_option, e):
+    if source_option == "Archived":
         st.error(f"Error fetching archived page: {e}")
-    return None
+    elif isinstance(e, requests.HTTPError):
+        st.error("Failed to fetch the current version of the page.")
+    else:
+        st.error(f"Error fetching current page: {e}")
 
-def fetch_current_page(url):
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            return response.text
+def fetch_html_pair(url, source1_option, date1, source2_option, date2):
+    # Both fetches are network-bound and independent, so run them side by side. Only the raising get_*
+    # functions run on the workers; errors are reported back here on the script thread, where st.error
+    # lands in the caller's container, in source order.
+    sources = ((source1_option, date1), (source2_option, date2))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(get_html, url, source_option, date) for source_option, date in sources]
+    pages = []
+    for (source_option, _), future in zip(sources, futures):
+        error = future.exception()
+        if error is None:
+            pages.append(future.result())
         else:
-            st.error("Failed to fetch the current version of the page.")
-    except Exception as e:
-        st.error(f"Error fetching current page: {e}")
-    return None
+            report_html_error(source_option, error)
+            pages.append(None)
+    return tuple(pages)
+
+# ndiff-style prefixes for diff-match-patch operations, so pretty_diff_both can read either
+DMP_PREFIXES = {diff_match_patch.DIFF_EQUAL: '  ', diff_match_patch.DIFF_INSERT: '+ ', diff_match_patch.DIFF_DELETE: '- '}
 
+def hash_lines(lines, table):
+    # Give every distinct line an integer id, shared through table, and pack the ids into a string
+    # with one character per line, so the diff compares single characters instead of whole lines
+    return ''.join([chr(table.setdefault(line, len(table))) for line in lines])
+
+def line_diff(text1, text2):
+    dmp = diff_match_patch()
+    dmp.Diff_Timeout = 5.0
+    table = {}
+    chars1 = hash_lines(text1.splitlines(keepends=True), table)
+    chars2 = hash_lines(text2.splitlines(keepends=True), table)
+    lines = list(table)
+    for op, chars in dmp.diff_main(chars1, chars2, False):
+        prefix = DMP_PREFIXES[op]
+        for char in chars:
+            yield prefix + lines[ord(char)]
+
+def ndiff_fast(a, b):
+    # ndiff-style '  '/'- '/'+ ' lines without the '? ' hints. The alignment is an LCS computed by rapidfuzz's
+    # C++ Indel distance over hashed items, so each sentence comparison is a single hash comparison, and
+    # there is no Differ._fancy_replace pass, which goes cubic on inputs with many equally similar lines.
+    # Indel reports a changed run as separate insert and delete opcodes in either order, so each run
+    # between equal blocks is collected and emitted removals first, like difflib and line_diff do.
+    deleted = []
+    inserted = []
+    for tag, i1, i2, j1, j2 in Indel.opcodes(a, b):
+        if tag == 'equal':
+            yield from ('- ' + line for line in deleted)
+            yield from ('+ ' + line for line in inserted)
+            deleted.clear()
+            inserted.clear()
+            yield from ('  ' + line for line in a[i1:i2])
+        else:
+            deleted.extend(a[i1:i2])
+            inserted.extend(b[j1:j2])
+    yield from ('- ' + line for line in deleted)
+    yield from ('+ ' + line for line in inserted)
+
+@st.cache_data(max_entries=32, show_spinner=False, hash_funcs=HASH_FUNCS)
 def compute_diff(text1, text2):
     if isinstance(text1, list) and isinstance(text2, list):
-        diff = difflib.ndiff(text1, text2)
+        diff = ndiff_fast(text1, text2)
     else:
-        diff = difflib.ndiff(text1.splitlines(keepends=True), text2.splitlines(keepends=True))
+        diff = line_diff(text1, text2)
     return list(diff)
 
+# One parsed tree per document, shared by the Head, Body and Extracted Text Content views. The tree
+# is only ever read, so handing the same object to every caller is safe.
+@st.cache_resource(max_entries=8, show_spinner=False, hash_funcs=HASH_FUNCS)
+def parse_html(html_content):
+    return BeautifulSoup(html_content, 'lxml')
+
+@st.cache_data(max_entries=32, show_spinner=False, hash_funcs=HASH_FUNCS)
 def extract_html_part(html_content, part, include_title_and_meta=False):
-    soup = BeautifulSoup(html_content, 'html.parser')
+    soup = parse_html(html_content)
     if part == "Head":
         return str(soup.head) if soup.head else ""
     elif part == "Body":
@@ -74,66 +189,127 @@ def extract_html_part(html_content, part, include_title_and_meta=False):
         return text_content
     return html_content
 
-def pretty_diff(diff, escape_html=True, strip_whitespace=False, format_for_ai=False, show_only_changes=False):
-    formatted_diff = []
+# Highlighting for added and removed lines in the HTML view
+ADDED_LINE_OPEN = "<span style='background-color: #ddffdd;'>"
+REMOVED_LINE_OPEN = "<span style='background-color: #ffdddd;'>"
+
+# The diff as shown on the page, one HTML string per line so it can be paged, and as sent to the AI prompt
+PrettyDiff = namedtuple('PrettyDiff', ['html_lines', 'ai'])
+
+def pretty_diff_both(diff, show_only_changes=False):
+    # Builds the highlighted HTML lines and the plain, whitespace-stripped lines for the AI prompt
+    # in a single walk over the diff
+    html_lines = []
+    ai_lines = []
+    html_append = html_lines.append
+    ai_append = ai_lines.append
+    # html.escape's chained str.replace calls are about 5x faster on diff lines than a str.translate table
+    escape = html.escape
     line_num_1 = line_num_2 = 0
+    changed_contents = {change_line[2:].strip() for change_line in diff if change_line[0] in '+-'} if show_only_changes else set()
 
     for line in diff:
-        content = line[2:].strip() if strip_whitespace else line[2:]
+        content = line[2:]
+        html_content = escape(content)
+        ai_content = content.strip()
         line_indicator = line[0]
 
-        if escape_html:
-            content = html.escape(content)
-
         if line_indicator == ' ':
             if show_only_changes:
-                if format_for_ai:
-                    continue
-                else:
-                    # Check if the sentence has any changes
-                    if any(change_line[0] in ['+', '-'] for change_line in diff if change_line[2:].strip() == content):
-                        formatted_line = f"<span>{content}</span>" if content else "[Blank Line]"
-                        formatted_diff.append(formatted_line)
+                # Check if the sentence has any changes
+                if html_content in changed_contents:
+                    html_append(f"<span>{html_content}</span>" if html_content else "[Blank Line]")
             else:
                 line_num_1 += 1
                 line_num_2 += 1
-                line_prefix = f"{line_num_1}: " if format_for_ai else f"{line_num_1}: "
-                if format_for_ai:
-                    formatted_line = f"{line_prefix} {content}" if content else f"{line_prefix} [Blank Line]"
-                else:
-                    formatted_line = f"{line_prefix} {content}" if content else f"{line_prefix} [Blank Line]"
-                formatted_diff.append(formatted_line)
+                html_append(f"{line_num_1}:  {html_content or '[Blank Line]'}")
+                ai_append(f"{line_num_1}:  {ai_content or '[Blank Line]'}")
         elif line_indicator == '+':
             line_num_2 += 1
-            line_prefix = f"+{line_num_2}: " if format_for_ai else f"+{line_num_2}: "
-            if format_for_ai:
-                formatted_line = f"{line_prefix} {content}" if content else f"{line_prefix} [Blank Line]"
-            else:
-                formatted_line = f"<span style='background-color: #ddffdd;'>{line_prefix} {content}</span>" if content else f"<span style='background-color: #ddffdd;'>{line_prefix} [Blank Line]</span>"
-            formatted_diff.append(formatted_line)
+            html_append(f"{ADDED_LINE_OPEN}+{line_num_2}:  {html_content or '[Blank Line]'}</span>")
+            ai_append(f"+{line_num_2}:  {ai_content or '[Blank Line]'}")
         elif line_indicator == '-':
             line_num_1 += 1
-            line_prefix = f"-{line_num_1}: " if format_for_ai else f"-{line_num_1}: "
-            if format_for_ai:
-                formatted_line = f"{line_prefix} {content}" if content else f"{line_prefix} [Blank Line]"
-            else:
-                formatted_line = f"<span style='background-color: #ffdddd;'>{line_prefix} {content}</span>" if content else f"<span style='background-color: #ffdddd;'>{line_prefix} [Blank Line]</span>"
-            formatted_diff.append(formatted_line)
+            html_append(f"{REMOVED_LINE_OPEN}-{line_num_1}:  {html_content or '[Blank Line]'}</span>")
+            ai_append(f"-{line_num_1}:  {ai_content or '[Blank Line]'}")
+
+    return PrettyDiff(html_lines, '\n'.join(ai_lines))
 
-    return '\n'.join(formatted_diff) if format_for_ai else '<br>'.join(formatted_diff)
+# One client per API key, kept across reruns so its pooled HTTP/2 connection is reused instead of
+# paying for a new TLS handshake on every analysis. Bounded, so keys typed into the app don't pile up clients.
+@st.cache_resource(max_entries=16, ttl=3600, show_spinner=False)
+def openai_client(api_key):
+    return openai.OpenAI(api_key=api_key, http_client=openai.DefaultHttpxClient(http2=True))
+
+# Finished analyses keyed by (model, prompt digest), shared across reruns and sessions so an identical
+# request isn't paid for twice. Answers are streamed, which st.cache_data can't replay, hence a plain dict.
+# The API key is deliberately not part of the key.
+@st.cache_resource(show_spinner=False)
+def completed_analyses():
+    return {}
+
+# Analyses finish on several executor threads at once; eviction and insertion go through this lock
+@st.cache_resource(show_spinner=False)
+def completed_analyses_lock():
+    return threading.Lock()
+
+MAX_COMPLETED_ANALYSES = 128
 
 def analyze_diff_with_ai(model, prompt, api_key):
-    openai.api_key = api_key
+    # Yields the response as it streams in, so the first tokens show up without waiting for the full answer
+    analyses = completed_analyses()
+    analysis_key = (model, hash_str(prompt))
+    analysis = analyses.get(analysis_key)
+    if analysis is not None:
+        yield analysis
+        return
+
+    parts = []
     try:
-        response = openai.ChatCompletion.create(
+        client = openai_client(api_key)
+        response = client.chat.completions.create(
             model=model,
             messages=[{"role": "system", "content": "You are a helpful assistant."},
-                      {"role": "user", "content": prompt}]
+                      {"role": "user", "content": prompt}],
+            stream=True
         )
-        return response['choices'][0]['message']['content']
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield parts[-1]
     except Exception as e:
-        return f"An error occurred: {e}"
+        yield f"An error occurred: {e}"
+    else:
+        # Errors are never stored, so the next click retries them
+        with completed_analyses_lock():
+            if len(analyses) >= MAX_COMPLETED_ANALYSES:
+                analyses.pop(next(iter(analyses)), None)
+            analyses[analysis_key] = "".join(parts)
+
+# Analyses run on these threads so the script, and with it the page, never blocks on the model
+@st.cache_resource(show_spinner=False)
+def analysis_executor():
+    return ThreadPoolExecutor(max_workers=4)
+
+def run_analysis(model, prompt, api_key, parts):
+    # parts is shared with the script, which shows what has streamed in so far on each rerun
+    for text in analyze_diff_with_ai(model, prompt, api_key):
+        parts.append(text)
+    return "".join(parts)
+
+def show_analysis_result(polling):
+    future = st.session_state.analysis_future
+    if future.done():
+        if polling:
+            # Rerun the whole script once so the result is shown without the polling timer
+            st.rerun()
+        st.text_area("Analysis Result", value=future.result(), height=150)
+    else:
+        st.markdown("".join(st.session_state.analysis_parts) or "Analyzing...")
     
+# Diff lines rendered per page in the diff view
+DIFF_PAGE_SIZE = 500
+
 # Streamlit App Structure
 st.title("🧠 SEODiff")
 st.markdown("## Webpage HTML Diff with Wayback Machine Support")
@@ -162,8 +338,7 @@ with st.sidebar:
     show_only_changes = st.checkbox("Show Only Changes", value=False)
 
     if st.button("Fetch HTML for Comparison"):
-        html1 = fetch_archived_page(wayback_url, selected_date_1) if source1_option == "Archived" else fetch_current_page(wayback_url)
-        html2 = fetch_archived_page(wayback_url, selected_date_2) if source2_option == "Archived" else fetch_current_page(wayback_url)
+        html1, html2 = fetch_html_pair(wayback_url, source1_option, selected_date_1, source2_option, selected_date_2)
 
         if html1 and html2:
             if focus_on_html_part == "Extracted Text Content":
@@ -172,26 +347,45 @@ with st.sidebar:
             else:
                 st.session_state.text1 = extract_html_part(html1, focus_on_html_part)
                 st.session_state.text2 = extract_html_part(html2, focus_on_html_part)
+            # New texts invalidate the diff built from the previous ones
+            st.session_state.pop('diff', None)
+            st.session_state.pop('pretty', None)
+            st.session_state.pop('diff_page', None)
 
 if 'text1' in st.session_state and 'text2' in st.session_state:
-    diff = compute_diff(st.session_state.text1, st.session_state.text2)
-    pretty_diff_text = pretty_diff(diff, show_only_changes=show_only_changes)
-    st.markdown("<div class='scrollable-container'>" + pretty_diff_text + "</div>", unsafe_allow_html=True)
+    # Keep the diff and its rendering between reruns, so unrelated widget changes (the API key,
+    # the prompt, the page selector) don't diff and format everything again
+    if 'diff' not in st.session_state:
+        st.session_state.diff = compute_diff(st.session_state.text1, st.session_state.text2)
+    if st.session_state.get('pretty', (None,))[0] != show_only_changes:
+        st.session_state.pretty = (show_only_changes, pretty_diff_both(st.session_state.diff, show_only_changes=show_only_changes))
+    pretty = st.session_state.pretty[1]
+    # Only one page of the diff is sent to the browser per rerun, instead of the whole thing
+    page_count = max(1, -(-len(pretty.html_lines) // DIFF_PAGE_SIZE))
+    page = st.selectbox("Diff Page", range(1, page_count + 1), format_func=lambda p: f"{p} of {page_count}", key='diff_page') if page_count > 1 else 1
+    page_lines = pretty.html_lines[(page - 1) * DIFF_PAGE_SIZE:page * DIFF_PAGE_SIZE]
+    st.markdown("<div class='scrollable-container'>" + '<br>'.join(page_lines) + "</div>", unsafe_allow_html=True)
 
 st.header("AI Analysis of Diff")
 with st.form("ai_analysis_form"):
     api_key = st.text_input("Enter OpenAI API Key", type="password")
     model_choice = st.selectbox("Choose AI Model", ["gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4-32k", "gpt-4-turbo", "gpt-4.5-turbo", "gpt-4", "gpt-4-1106-preview"])
     if 'text1' in st.session_state and 'text2' in st.session_state:
-        ai_analysis_text = pretty_diff(diff, escape_html=False, strip_whitespace=True, format_for_ai=True, show_only_changes=show_only_changes)
+        ai_analysis_text = pretty.ai
     else:
         ai_analysis_text = ""
     user_prompt = st.text_area("Customize the Prompt", value=f"Analyze the changes as specified from the output via python's difflib, taking into account the included line numbers. A '-' before a line means it was removed. A '+' before a line means it was added. Make sure to note anything that may impact SEO such as canonical, hreflang, schema, links, or content changes. Summarize the results.\n\n{ai_analysis_text}", height=150)
     analyze_button = st.form_submit_button("Analyze Diff")
 
     if analyze_button and api_key:
-        analysis_result = analyze_diff_with_ai(model_choice, user_prompt, api_key)
-        st.text_area("Analysis Result", value=analysis_result, height=150)
+        analysis_parts = []
+        st.session_state.analysis_parts = analysis_parts
+        st.session_state.analysis_future = analysis_executor().submit(run_analysis, model_choice, user_prompt, api_key, analysis_parts)
+
+if 'analysis_future' in st.session_state:
+    # While the analysis is running, only this fragment reruns to pick up newly streamed text
+    pending = not st.session_state.analysis_future.done()
+    st.fragment(run_every=0.5 if pending else None)(show_analysis_result)(pending)
 
 st.markdown(""" 
     <style>
@@ -202,4 +396,4 @@ st.markdown("""
             padding: 10px; 
         }
     </style>
-    """, unsafe_allow_html=True)
\ No newline at end of file
+    """, unsafe_allow_html=True)